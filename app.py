@@ -1,29 +1,426 @@
-import io
+import atexit
+import glob
+import hashlib
+import mmap
 import os
+import pickle
+import queue
+import re
 import shutil
 import subprocess
 import tempfile
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
 
-from flask import Flask, abort, request, send_file
+from flask import Flask, abort, jsonify, request
 from flask_caching import Cache
+from flask_caching.backends.base import BaseCache
+
+try:
+    from playwright.sync_api import Error as PlaywrightError
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+    from playwright.sync_api import sync_playwright
+except ImportError:  # Playwright is optional; fall back to the Firefox CLI
+    sync_playwright = None  # type: ignore[assignment]
+
+try:
+    import pyvips
+except (ImportError, OSError):  # libvips is optional; only PNGs are served
+    pyvips = None  # type: ignore[assignment]
+
+
+class RawBytesCache(BaseCache):
+    """
+    In-memory cache for single-process deployments. Unlike SimpleCache it
+    stores bytes values (the screenshots), and tuples of bytes and str, as
+    they are instead of pickling them on every set and get; other values are
+    still pickled. The least recently used entries are evicted once the
+    stored values exceed `max_bytes`.
+    Select it with CACHE_TYPE="app.RawBytesCache" (e.g. FLASK_CACHE_TYPE).
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, default_timeout=300, **kwargs):
+        super().__init__(default_timeout=default_timeout, **kwargs)
+        self.max_bytes = max_bytes
+        self._store = OrderedDict()  # key -> (expires_at, data, pickled, size)
+        self._size = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(max_bytes=config["CACHE_MAX_BYTES"])
+        return cls(*args, **kwargs)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                return None
+            self._store.move_to_end(key)
+
+        _, data, pickled, _ = entry
+        return pickle.loads(data) if pickled else data
+
+    def set(self, key, value, timeout=None):
+        if isinstance(value, (bytes, bytearray)):
+            data, pickled, size = bytes(value), False, len(value)
+        elif isinstance(value, tuple) and all(
+            isinstance(item, (bytes, str)) for item in value
+        ):
+            data, pickled, size = value, False, sum(map(len, value))
+        else:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            pickled, size = True, len(data)
+
+        if size > self.max_bytes:
+            # Don't leave an older value behind the one that was refused
+            self.delete(key)
+            return False
+
+        timeout = self._normalize_timeout(timeout)
+        expires_at = time.monotonic() + timeout if timeout else None
+
+        with self._lock:
+            self._remove(key)
+            self._store[key] = (expires_at, data, pickled, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._store)))
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._live_entry(key) is not None:
+                return False
+            return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def has(self, key):
+        with self._lock:
+            return self._live_entry(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+            self._size = 0
+        return True
+
+    def _live_entry(self, key):
+        entry = self._store.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+            self._remove(key)
+            return None
+        return entry
+
+    def _remove(self, key):
+        entry = self._store.pop(key, None)
+        if entry is None:
+            return False
+        self._size -= entry[3]
+        return True
+
 
 # App and Cache Configuration
 config = {
-    "DEBUG": True,
-    "CACHE_TYPE": "SimpleCache",  # Uses a simple in-memory cache
+    "DEBUG": False,
+    "CACHE_TYPE": "FileSystemCache",  # Shared by every thread and worker process
+    "CACHE_DIR": os.path.join(tempfile.gettempdir(), "screenshotter"),
+    "CACHE_THRESHOLD": 20000,  # Cache entries; 10000 screenshots as PNG + WebP
+    "CACHE_MAX_BYTES": 512 * 1024 * 1024,  # Memory budget of RawBytesCache
     "CACHE_DEFAULT_TIMEOUT": 3600,  # Default cache timeout in seconds (1 hour)
+    "ALLOWED_DOMAINS": [],  # Domains (and subdomains) to allow; empty allows any
+    "FIREFOX_TIMEOUT": 15,  # Seconds per capture; gunicorn.conf.py reads it too
 }
 
 app = Flask(__name__)
 app.config.from_mapping(config)
+# Any setting can be overridden with a FLASK_-prefixed environment variable,
+# e.g. FLASK_CACHE_DIR=/var/cache/screenshotter
+app.config.from_prefixed_env()
 cache = Cache(app)
 
 # Set a timeout for the Firefox command (in seconds)
-FIREFOX_TIMEOUT = 15
+FIREFOX_TIMEOUT = int(app.config["FIREFOX_TIMEOUT"])
+
+# Number of persistent headless browsers kept warm per process
+# (one per gunicorn thread, see gunicorn.conf.py)
+BROWSER_POOL_SIZE = 4
+
+# Number of reusable in-memory Firefox profiles, which is also how many
+# `firefox --screenshot` processes may run at once per process. Under the
+# gevent worker far more requests than this are in flight; the rest wait up
+# to FIREFOX_TIMEOUT for a profile and then get a 504. Each Firefox needs a
+# few hundred MB of RAM, so size this to the host, not to the connections.
+FIREFOX_PROFILES = 4
 
-# A lock to prevent race conditions with the default 'screenshot.png' filename
-firefox_lock = threading.Lock()
+# Longest a capture can take end to end: waiting for a free profile or
+# browser, loading and screenshotting the page, then recompressing the PNG
+# (each bounded by FIREFOX_TIMEOUT), plus a margin for the WebP encode
+CAPTURE_TIMEOUT = 4 * FIREFOX_TIMEOUT + 5
+
+# Matches the window size Firefox uses for `--screenshot`
+VIEWPORT = {"width": 1366, "height": 768}
+
+# Lossless PNG optimizer run once per capture, before caching (optional)
+OXIPNG = shutil.which("oxipng")
+
+# Image formats every screenshot is cached in, in order of preference when
+# the client accepts both equally
+IMAGE_MIMETYPES = {"png": "image/png", "webp": "image/webp"}
+
+# Maximum number of URLs accepted by one /screenshot/batch request
+BATCH_MAX = 16
+
+# Memory budget of the screenshots each process keeps in front of the shared
+# cache, and how long one copied from the shared cache is kept (its remaining
+# lifetime there is unknown, so it mustn't outlive it by much)
+MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+MEMORY_CACHE_TIMEOUT = 60
+
+# Ports that are implied by the scheme and dropped when normalizing URLs
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Shards for in-flight captures, each with its own lock
+INFLIGHT_SHARDS = 8
+
+
+class BrowserPoolUnavailable(Exception):
+    """The pooled browsers could not be launched (e.g. not installed)."""
+
+
+class BrowserPool:
+    """
+    A fixed set of long-lived headless Firefox browsers driven by Playwright.
+    Playwright's sync API is bound to the thread that created it, so every
+    browser lives on its own worker thread and jobs are handed over a queue.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.jobs = queue.Queue()
+        self.available = True
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Launches the worker threads (once)."""
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self.size):
+                worker = threading.Thread(
+                    target=self._worker, name=f"browser-{i}", daemon=True
+                )
+                worker.start()
+            self._started = True
+
+    def capture(self, url):
+        """
+        Queues `url` for a free browser and blocks until its PNG is ready.
+        Raises BrowserPoolUnavailable if the browsers could not be launched.
+        """
+        self.start()
+        job = Future()
+        self.jobs.put((url, job))
+        try:
+            # Queueing for a browser, loading and screenshotting
+            return job.result(timeout=3 * FIREFOX_TIMEOUT)
+        except FutureTimeoutError:
+            job.cancel()  # Skipped by the browsers if it is still queued
+            raise abort(504, description="Screenshot command timed out.")
+
+    def _worker(self):
+        try:
+            with sync_playwright() as playwright:
+                browser = playwright.firefox.launch(headless=True)
+                self._serve(playwright, browser)
+        except Exception as e:
+            app.logger.error(
+                f"Browser pool failed to start, using the firefox command: {e}"
+            )
+            self.available = False
+            # Hand queued jobs back to the caller instead of leaving them hanging
+            while True:
+                _, job = self.jobs.get()
+                if job.set_running_or_notify_cancel():
+                    job.set_exception(BrowserPoolUnavailable(str(e)))
+
+    def _serve(self, playwright, browser):
+        while True:
+            url, job = self.jobs.get()
+            if not job.set_running_or_notify_cancel():
+                continue
+
+            try:
+                if not browser.is_connected():
+                    # The browser crashed during an earlier job; start a new one
+                    app.logger.warning("Pooled browser disconnected, relaunching")
+                    browser = playwright.firefox.launch(headless=True)
+
+                app.logger.info(f"CACHE MISS: Capturing {url} with pooled browser")
+                job.set_result(self._screenshot(browser, url))
+            except Exception as e:
+                job.set_exception(e)
+
+    def _screenshot(self, browser, url):
+        # A fresh context per job, so cookies and storage set by one URL
+        # never leak into another capture
+        context = browser.new_context(viewport=VIEWPORT)
+        try:
+            page = context.new_page()
+            page.goto(url, timeout=FIREFOX_TIMEOUT * 1000)
+            # The whole page, like `firefox --screenshot`
+            return page.screenshot(
+                type="png", full_page=True, timeout=FIREFOX_TIMEOUT * 1000
+            )
+        finally:
+            try:
+                context.close()
+            except Exception:
+                pass  # The browser is gone; it is relaunched for the next job
+
+
+class ProfilePool:
+    """
+    Firefox profiles kept in RAM (tmpfs) and reused across CLI captures, so a
+    launch does not read and write hundreds of small profile files on disk.
+    A profile can only be used by one Firefox at a time, and is emptied after
+    each capture so cookies and storage from one URL never reach the next.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self._profiles = queue.Queue()
+        self._created = False
+        self._create_lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        """Lends out a free profile directory for the duration of the block."""
+        self._create()
+        try:
+            profile = self._profiles.get(timeout=FIREFOX_TIMEOUT)
+        except queue.Empty:
+            raise abort(504, description="Screenshot command timed out.")
+
+        try:
+            yield profile
+        finally:
+            shutil.rmtree(profile, ignore_errors=True)
+            os.makedirs(profile, exist_ok=True)
+            self._profiles.put(profile)
+
+    def _create(self):
+        # Created on first use so every (forked) worker process gets its own
+        with self._create_lock:
+            if self._created:
+                return
+            self._remove_stale()
+            for i in range(self.size):
+                profile = os.path.join(
+                    self.root, f"screenshotter-profile-{os.getpid()}-{i}"
+                )
+                os.makedirs(profile, exist_ok=True)
+                atexit.register(shutil.rmtree, profile, ignore_errors=True)
+                self._profiles.put(profile)
+            self._created = True
+
+    def _remove_stale(self):
+        # atexit does not run for killed workers (e.g. on gunicorn's timeout),
+        # so profiles of processes that no longer exist are cleaned up here
+        for profile in glob.glob(os.path.join(self.root, "screenshotter-profile-*")):
+            pid = os.path.basename(profile).split("-")[2]
+            if pid.isdigit() and not _process_exists(int(pid)):
+                shutil.rmtree(profile, ignore_errors=True)
+
+
+def _process_exists(pid):
+    if os.name != "posix":
+        return True  # Signal 0 would terminate the process on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, but belongs to another user
+    return True
+
+
+class InflightRequests:
+    """
+    Coalesces concurrent cache misses for the same key.
+    The first caller runs the capture; callers arriving while it is still in
+    flight wait for it and share its result (or its error). Keys are spread
+    over independently locked shards so unrelated URLs never contend.
+    """
+
+    def __init__(self, shards, timeout):
+        self.timeout = timeout
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+
+    def run(self, key, func):
+        """Returns `func()`, running it only once for concurrent callers."""
+        lock, calls = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            call = calls.get(key)
+            is_producer = call is None
+            if is_producer:
+                call = calls[key] = Future()
+
+        if not is_producer:
+            try:
+                return call.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                raise abort(504, description="Screenshot command timed out.")
+
+        try:
+            call.set_result(func())
+        except Exception as e:
+            call.set_exception(e)
+        finally:
+            with lock:
+                del calls[key]
+        return call.result()
+
+
+firefox_profiles = ProfilePool(FIREFOX_PROFILES)
+
+inflight = InflightRequests(INFLIGHT_SHARDS, timeout=CAPTURE_TIMEOUT)
+
+# Screenshots served by this process, with their ETags, by `screenshot_key`
+memory_cache = RawBytesCache(max_bytes=MEMORY_CACHE_BYTES)
+
+# Runs the URLs of a batch side by side, at most one per pooled browser
+batch_executor = ThreadPoolExecutor(max_workers=max(BROWSER_POOL_SIZE, 1))
+
+
+def _running_on_greenlets():
+    """True under gevent's monkey-patching (e.g. gunicorn -k gevent)."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+# Playwright's sync API needs real threads, so gevent deployments fall back to
+# Firefox subprocesses, which gevent waits on cooperatively
+browser_pool = (
+    BrowserPool(BROWSER_POOL_SIZE)
+    if sync_playwright is not None
+    and BROWSER_POOL_SIZE > 0
+    and not _running_on_greenlets()
+    else None
+)
 
 
 @app.route("/screenshot")
@@ -38,18 +435,30 @@ def capture_screenshot():
     if not url:
         return abort(400, description="Missing 'url' query parameter.")
 
-    if not (url.startswith("http://") or url.startswith("https://")):
-        return abort(
-            400, description="Invalid URL. Must start with 'http://' or 'https://'."
-        )
+    validate_url(url)
+    url = normalize_url(url)
+
+    # Browsers that explicitly accept WebP get the much smaller variant
+    mimetype = request.accept_mimetypes.best_match(
+        IMAGE_MIMETYPES.values(), default=IMAGE_MIMETYPES["png"]
+    )
+    image_format = mimetype.split("/")[1]
 
     try:
-        # Call the memoized function to get the raw image data
-        # The cache key will be based on the 'url' argument
-        image_bytes = get_image_bytes(url)
+        # Serve from the caches, capturing on a miss; the format may fall back
+        # to PNG when the screenshot has no WebP variant
+        image_bytes, etag, image_format = load_screenshot(url, image_format)
+        mimetype = IMAGE_MIMETYPES[image_format]
 
-        # Send the bytes from memory using io.BytesIO
-        return send_file(io.BytesIO(image_bytes), mimetype="image/png")
+        # Hand the cached bytes to the WSGI server as the response body,
+        # without copying them through a file-like wrapper in 8 KB chunks;
+        # make_conditional answers If-None-Match with a 304 as well as
+        # Range and If-Range requests
+        response = app.response_class(image_bytes, mimetype=mimetype)
+        with_cache_headers(response, etag)
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=len(image_bytes)
+        )
     except Exception as e:
         # If get_image_bytes raised an abort (HTTPException), re-raise it
         if hasattr(e, "code"):
@@ -61,59 +470,343 @@ def capture_screenshot():
         return abort(500, description="Internal server error handling request.")
 
 
-@cache.memoize(timeout=3600)  # <-- CORRECT DECORATOR
+@app.route("/screenshot/batch", methods=["POST"])
+def capture_screenshot_batch():
+    """
+    Public-facing view.
+    Takes a JSON body like {"urls": [...]} and captures every URL that is not
+    cached yet, spreading them over the browser pool. The screenshots are then
+    served from the cache by the regular /screenshot endpoint.
+    """
+    payload = request.get_json(silent=True)
+    urls = payload.get("urls") if isinstance(payload, dict) else None
+
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        return abort(400, description="Expected a JSON body like {'urls': [...]}.")
+
+    if len(urls) > BATCH_MAX:
+        return abort(400, description=f"At most {BATCH_MAX} URLs per batch.")
+
+    results = list(batch_executor.map(warm_screenshot, urls))
+    return jsonify({"results": results})
+
+
+def warm_screenshot(url):
+    """Makes sure `url` is cached and reports the outcome for a batch."""
+    try:
+        validate_url(url)
+        normalized = normalize_url(url)
+        if not cache.has(screenshot_key(normalized, "png")):
+            load_images(normalized)
+        return {"url": url, "status": 200}
+    except Exception as e:
+        if hasattr(e, "code"):
+            return {"url": url, "status": e.code, "error": e.description}
+
+        app.logger.error(f"Unexpected error in batch for {url}: {e}")
+        return {"url": url, "status": 500, "error": "Internal server error."}
+
+
+def validate_url(url):
+    """Rejects anything Firefox should not be pointed at."""
+    if SCHEME_PATTERN.match(url) is None:
+        raise abort(
+            400, description="Invalid URL. Must start with 'http://' or 'https://'."
+        )
+
+    if ALLOWED_DOMAINS:
+        if UNSAFE_URL_CHARS.search(url):
+            raise abort(400, description="Invalid URL. Contains unsafe characters.")
+        try:
+            host = urlsplit(url).hostname
+        except ValueError:
+            host = None
+        if not is_allowed_host(host):
+            raise abort(
+                400, description="Invalid URL. Must be http(s) on an allowed domain."
+            )
+
+
+def is_allowed_host(host):
+    """
+    True if `host` is one of ALLOWED_DOMAINS or a subdomain of one. Every
+    suffix of the host is a single set lookup, however long the list grows.
+    """
+    if not host or HOSTNAME_PATTERN.fullmatch(host) is None:
+        return False
+
+    labels = host.rstrip(".").split(".")
+    return any(".".join(labels[i:]) in ALLOWED_DOMAINS for i in range(len(labels)))
+
+
+def parse_allowed_domains(value):
+    """
+    Reads the ALLOWED_DOMAINS setting: a list of domains, or a comma-separated
+    string of them (as FLASK_ALLOWED_DOMAINS=example.com,example.org gives).
+    Raises ValueError for anything else, so a typo fails at startup instead of
+    allowing the wrong hosts.
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    if not isinstance(value, (list, tuple)) or not all(
+        isinstance(domain, str) for domain in value
+    ):
+        raise ValueError(f"ALLOWED_DOMAINS must be a list of domains, got {value!r}")
+
+    domains = {domain.strip().lower().rstrip(".") for domain in value}
+    domains.discard("")
+    for domain in domains:
+        if HOSTNAME_PATTERN.fullmatch(domain) is None:
+            raise ValueError(f"ALLOWED_DOMAINS contains an invalid domain: {domain!r}")
+    return frozenset(domains)
+
+
+SCHEME_PATTERN = re.compile(r"https?://", re.IGNORECASE)
+
+# Browsers read "\" as "/" and drop whitespace and control characters, so the
+# host Firefox loads could differ from the one checked against the allowlist.
+# Only enforced with an allowlist: "?q=a+b" reaches us as "?q=a b".
+UNSAFE_URL_CHARS = re.compile(r"[\\\x00-\x20\x7f]")
+
+HOSTNAME_PATTERN = re.compile(r"[a-z0-9-]+(?:\.[a-z0-9-]+)*\.?")
+
+ALLOWED_DOMAINS = parse_allowed_domains(app.config["ALLOWED_DOMAINS"])
+
+
+def normalize_url(url):
+    """
+    Canonical form of `url`, so spellings Firefox renders identically share a
+    cache entry: lower-case scheme and host, no default port, no fragment,
+    "/" for an empty path and query parameters sorted by name.
+    """
+    try:
+        parts = urlsplit(url)
+    except ValueError:  # e.g. an unclosed "[" around an IPv6 host
+        raise abort(400, description="Invalid URL. Malformed host.")
+    try:
+        port = parts.port
+    except ValueError:
+        raise abort(400, description="Invalid URL. Bad port number.")
+
+    host = parts.hostname or ""
+    if ":" in host:  # IPv6 literal
+        host = f"[{host}]"
+    if port is not None and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = f"{host}:{port}"
+    if parts.username is not None:
+        userinfo = parts.netloc.rpartition("@")[0]
+        host = f"{userinfo}@{host}"
+
+    # Reorder the raw "key=value" segments without decoding and re-encoding
+    # them ("?flag" and "a/b" must reach the site as written); the sort is
+    # by key only and stable, so repeated keys keep their order
+    segments = sorted(
+        parts.query.split("&"), key=lambda segment: segment.partition("=")[0]
+    )
+    query = "&".join(segments)
+    return urlunsplit((parts.scheme.lower(), host, parts.path or "/", query, ""))
+
+
+def load_screenshot(url, image_format):
+    """
+    Returns the screenshot of `url` in `image_format`, its ETag and its actual
+    format, from this process' memory cache, the shared cache or a fresh
+    capture, in that order. The memory cache skips reading, unpickling and
+    hashing the hottest screenshots on every hit. Screenshots too large for
+    WebP are only cached as PNG, which is then returned instead.
+    """
+    key = screenshot_key(url, image_format)
+    screenshot = memory_cache.get(key)
+    if screenshot is not None:
+        return screenshot
+
+    timeout = MEMORY_CACHE_TIMEOUT
+    image_bytes = cache.get(key)
+    if image_bytes is None and image_format != "png":
+        # A cached PNG without its WebP means the WebP could not be encoded
+        image_bytes = cache.get(screenshot_key(url, "png"))
+        if image_bytes is not None:
+            image_format = "png"
+    if image_bytes is None:
+        images = load_images(url)
+        # Just captured, so it expires along with the shared cache's copy
+        timeout = app.config["CACHE_DEFAULT_TIMEOUT"]
+        if image_format not in images:
+            image_format = "png"
+        image_bytes = images[image_format]
+
+    # The ETag follows the content, so a screenshot captured again after it
+    # expired is never mistaken for the copy a client already has
+    digest = hashlib.sha256(url.encode())
+    digest.update(image_bytes)
+    screenshot = (image_bytes, digest.hexdigest(), image_format)
+    memory_cache.set(key, screenshot, timeout)
+    return screenshot
+
+
+def load_images(url):
+    """
+    Captures `url`; concurrent misses for the same URL share a single capture
+    instead of each launching Firefox.
+    """
+    return inflight.run(url, lambda: get_image_bytes(url))
+
+
+def screenshot_key(url, image_format):
+    """Cache key of the screenshot of `url` in `image_format`."""
+    return f"{hashlib.sha256(url.encode()).hexdigest()}.{image_format}"
+
+
+def with_cache_headers(response, etag):
+    """
+    Lets browsers and CDNs keep the screenshot as long as we do, without
+    revalidating it in the meantime (a given capture never changes).
+    """
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    response.headers["Cache-Control"] = (
+        f"public, max-age={app.config['CACHE_DEFAULT_TIMEOUT']}, immutable"
+    )
+    return response
+
+
 def get_image_bytes(url):
     """
     Worker function.
-    Generates the screenshot and returns the raw bytes.
-    The result of this function is memoized based on the 'url' argument.
+    Generates the screenshot, stores every format it could be encoded in in
+    the cache under its `screenshot_key` and returns the raw bytes keyed by
+    format (PNG is always present).
+    """
+    if browser_pool is not None and browser_pool.available:
+        image_bytes = _capture_with_pool(url)
+    else:
+        image_bytes = _capture_with_firefox(url)
+
+    # Paid once per capture; every cache hit then serves the smaller file
+    images = {"png": optimize_png(image_bytes)}
+    if pyvips is not None:
+        try:
+            images["webp"] = encode_webp(image_bytes)
+        except pyvips.Error as e:
+            # e.g. full-page captures taller than WebP's 16383 px limit
+            app.logger.warning(f"Could not encode WebP for {url}, keeping PNG: {e}")
+
+    for image_format, data in images.items():
+        cache.set(screenshot_key(url, image_format), data)
+    return images
+
+
+def optimize_png(image_bytes):
+    """Losslessly recompresses a PNG with oxipng, if it is installed."""
+    if OXIPNG is None:
+        return image_bytes
+
+    try:
+        result = subprocess.run(
+            [OXIPNG, "-o", "2", "--strip", "safe", "--stdout", "-"],
+            input=image_bytes,
+            timeout=FIREFOX_TIMEOUT,
+            check=True,
+            capture_output=True,
+        )
+    except (subprocess.SubprocessError, OSError) as e:
+        app.logger.warning(f"oxipng failed, caching the original PNG: {e}")
+        return image_bytes
+
+    optimized = result.stdout
+    if not optimized or len(optimized) >= len(image_bytes):
+        return image_bytes
+    return optimized
+
+
+def encode_webp(png_bytes):
+    """
+    Re-encodes a PNG screenshot as a lossy WebP, several times smaller.
+    libvips streams the pixels through its (SIMD) pipeline instead of
+    decoding the whole image into Python objects first.
+    """
+    image = pyvips.Image.new_from_buffer(png_bytes, "", access="sequential")
+    return image.write_to_buffer(".webp", Q=80, effort=6)
+
+
+def read_file(path):
+    """
+    Reads a whole (non-empty) file with a single copy out of the page cache,
+    skipping the small-buffer reads of Python's buffered I/O.
     """
-    output_path = None
-    default_screenshot_file = os.path.join(os.getcwd(), "screenshot.png")
+    with open(path, "rb", buffering=0) as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return bytes(mm)
 
+
+def _capture_with_pool(url):
+    """Takes the screenshot on a warm browser from the pool."""
     try:
-        # 1. Create a unique destination path
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=True) as temp:
-            output_path = temp.name
+        return browser_pool.capture(url)
+
+    except BrowserPoolUnavailable:
+        return _capture_with_firefox(url)
+
+    except PlaywrightTimeoutError:
+        app.logger.warning(f"Pooled browser timed out for URL: {url}")
+        raise abort(504, description="Screenshot command timed out.")
+
+    except PlaywrightError as e:
+        app.logger.error(f"Pooled browser failed for URL {url}: {e}")
+        raise abort(500, description=f"Firefox failed to take screenshot. Error: {e}")
 
-        # 2. Acquire lock
-        with firefox_lock:
-            # 3. Clean up old file
-            if os.path.exists(default_screenshot_file):
-                os.remove(default_screenshot_file)
 
-            # 4. Construct command
-            command = ["firefox", "--headless", "--screenshot", url]  # No filename
+def _capture_with_firefox(url):
+    """Takes the screenshot by launching a one-off `firefox --headless`."""
+    # Each run gets a private working directory, so concurrent Firefox
+    # processes never write to the same files and need no shared lock
+    workdir = tempfile.mkdtemp(prefix="screenshotter-")
+    output_path = os.path.join(workdir, "screenshot.png")
 
-            # 5. Execute command
+    try:
+        with firefox_profiles.acquire() as profile:
+            # 1. Construct command
+            command = [
+                "firefox",
+                "--headless",
+                "--no-remote",
+                "--profile",
+                profile,
+                "--screenshot",
+                output_path,
+                url,
+            ]
+
+            # 2. Execute command; stdout is unused and stderr is only decoded
+            # when something went wrong
             app.logger.info(f"CACHE MISS: Running Firefox for {url}")
             result = subprocess.run(
                 command,
+                cwd=workdir,
                 timeout=FIREFOX_TIMEOUT,
                 check=True,
-                capture_output=True,
-                text=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
             )
 
-            # 6. Check for file creation
-            if (
-                not os.path.exists(default_screenshot_file)
-                or os.path.getsize(default_screenshot_file) == 0
-            ):
-                app.logger.error(
-                    f"Firefox command ran but produced no file. Stderr: {result.stderr}"
-                )
-                # Raise an exception that the route can catch
-                raise abort(
-                    500, description="Firefox ran but failed to produce a screenshot."
-                )
+        # 3. Check for file creation (a single stat call)
+        try:
+            output_size = os.stat(output_path).st_size
+        except FileNotFoundError:
+            output_size = 0
 
-            # 7. Move file
-            shutil.move(default_screenshot_file, output_path)
+        if output_size == 0:
+            stderr = result.stderr.decode("utf-8", "replace")
+            app.logger.error(
+                f"Firefox command ran but produced no file. Stderr: {stderr}"
+            )
+            # Raise an exception that the route can catch
+            raise abort(
+                500, description="Firefox ran but failed to produce a screenshot."
+            )
 
-        # 8. Read the file bytes into memory
-        with open(output_path, "rb") as f:
-            image_bytes = f.read()
+        # 4. Read the file bytes into memory
+        image_bytes = read_file(output_path)
 
         return image_bytes  # This (the bytes) is what gets cached
 
@@ -122,11 +815,12 @@ def get_image_bytes(url):
         raise abort(504, description="Screenshot command timed out.")
 
     except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode("utf-8", "replace")
         app.logger.error(
-            f"Firefox command failed with code {e.returncode}. Stderr: {e.stderr}"
+            f"Firefox command failed with code {e.returncode}. Stderr: {stderr}"
         )
         raise abort(
-            500, description=f"Firefox failed to take screenshot. Error: {e.stderr}"
+            500, description=f"Firefox failed to take screenshot. Error: {stderr}"
         )
 
     except FileNotFoundError:
@@ -143,21 +837,11 @@ def get_image_bytes(url):
         raise abort(500, description="An unexpected server error occurred in worker.")
 
     finally:
-        # 9. Clean up all files
-        if os.path.exists(default_screenshot_file):
-            try:
-                os.remove(default_screenshot_file)
-            except Exception as e:
-                app.logger.error(f"Failed to remove lingering default file: {e}")
-
-        if output_path and os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-            except Exception as e:
-                app.logger.error(f"Failed to remove temp file {output_path}: {e}")
+        # 5. Clean up the screenshot along with the working directory
+        shutil.rmtree(workdir, ignore_errors=True)
 
 
 if __name__ == "__main__":
-    # Use 'threaded=True' for the lock to work properly with multiple requests
+    # Use 'threaded=True' so screenshots for different requests run concurrently
     # Port set to 11754
     app.run(debug=True, host="0.0.0.0", port=11754, threaded=True)
@@ -0,0 +1,35 @@
+"""
+Gunicorn settings for production:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+A fixed number of pre-forked workers, each with a bounded thread pool,
+replaces the development server's unbounded thread-per-request model.
+
+Without the Playwright browser pool, every capture is a Firefox subprocess
+the request merely waits on. Those deployments can use the gevent worker
+instead, where each request is a greenlet rather than an OS thread:
+
+    gunicorn -c gunicorn.conf.py -k gevent app:app
+"""
+
+import os
+
+# Note: this file must not import the app. The gevent worker monkey-patches
+# the standard library before loading it, and locks created earlier would
+# block the whole worker.
+
+bind = "0.0.0.0:11754"
+
+# One process per core; every worker starts its own browser pool on first use
+workers = os.cpu_count() or 1
+worker_class = "gthread"
+threads = 4
+
+# Leave room for a full Firefox timeout before a worker is considered stuck.
+# Read from the same variable that overrides the app's FIREFOX_TIMEOUT (and
+# with the same default), so the two can't drift apart.
+timeout = int(os.environ.get("FLASK_FIREFOX_TIMEOUT", 15)) + 10
+
+# Concurrent requests per worker when running with -k gevent
+worker_connections = 1000
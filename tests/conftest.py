@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Keep the test run's cache away from a running server's, then make `app`
+# importable from the repository root
+os.environ.setdefault(
+    "FLASK_CACHE_DIR", os.path.join(tempfile.mkdtemp(), "screenshotter")
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))